@@ -1,9 +1,20 @@
 import subprocess
 import sys
 import os
-import glob
+import re
 import shutil
+import tempfile
 import webbrowser
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+try:
+    import psycopg  # Opcional (pip install "psycopg[binary]"): evita lanzar psql para activar PostGIS
+except ImportError:
+    psycopg = None
+
+# Errores esperables al hablar con la base (subprocesos y, si está, psycopg)
+_DB_ERRORS = (OSError, psycopg.Error) if psycopg is not None else (OSError,)
 
 # --- CONFIGURACIÓN ---
 # Configuración para PostGIS en Docker (docker-compose.yml)
@@ -14,26 +25,92 @@ DB_USER = "postgres"
 DB_PASSWORD = "postgres"  # Contraseña según docker-compose.yml
 DB_SSLMODE = "disable"
 
-INPUT_FILENAME = "GisTPI" 
+# Archivo a importar: se puede pasar como argumento (python import.py ruta/al/archivo)
+INPUT_FILENAME = sys.argv[1] if len(sys.argv) > 1 else "GisTPI"
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Entorno para psql/pg_restore, construido una sola vez y compartido por todos los subprocesos.
+# Con PGCLIENTENCODING=UTF8 su salida se lee siempre con encoding="utf-8" (no con el código de página local)
+_PG_ENV = {**os.environ, "PGPASSWORD": DB_PASSWORD, "PGCLIENTENCODING": "UTF8"}
+
+# Ajustes de sesión para la carga masiva (solo afectan a las conexiones de la importación).
+# maintenance_work_mem se reserva por proceso de pg_restore, por eso no es mayor.
+BULK_LOAD_OPTIONS = "-c synchronous_commit=off -c maintenance_work_mem=512MB"
+_PG_BULK_ENV = {**_PG_ENV, "PGOPTIONS": f"{os.environ.get('PGOPTIONS', '')} {BULK_LOAD_OPTIONS}".strip()}
+
+def _env_jobs():
+    """Lee PG_RESTORE_JOBS; devuelve None si no está o no es un entero positivo."""
+    value = os.environ.get("PG_RESTORE_JOBS", "")
+    if value.strip().isdigit() and int(value) > 0:
+        return int(value)
+    if value:
+        print(f"⚠️ PG_RESTORE_JOBS='{value}' no es válido, se usa el valor por defecto.", file=sys.stderr)
+    return None
+
+# Procesos paralelos de pg_restore (-j). Se puede forzar con la variable de entorno PG_RESTORE_JOBS
+_ENV_JOBS = _env_jobs()
+PG_RESTORE_JOBS = _ENV_JOBS or min(os.cpu_count() or 1, 4)
+# Con un dump en formato directorio (pg_dump -Fd) cada tabla es un archivo y se pueden usar más núcleos.
+# Tope de 8: cada proceso es una conexión más y reserva su propio maintenance_work_mem (BULK_LOAD_OPTIONS).
+PG_RESTORE_DIR_JOBS = _ENV_JOBS or min(os.cpu_count() or 1, 8)
 
 # --- HERRAMIENTAS ---
+# Carpetas donde suelen instalarse las herramientas en Windows: (carpeta base, prefijo de subcarpeta).
+# Con prefijo None la carpeta base ya es el directorio bin.
+COMMON_PATHS = [
+    (r"C:\Program Files\PostgreSQL", ""),
+    (r"C:\Program Files (x86)\PostgreSQL", ""),
+    (r"C:\OSGeo4W\bin", None),
+    (r"C:\Program Files", "QGIS"),
+]
+
+def _version_key(name):
+    """Clave numérica de versión de una carpeta ("17" -> (17,), "QGIS 3.34.1" -> (3, 34, 1))."""
+    return tuple(int(n) for n in re.findall(r"\d+", name))
+
+def _subdirs(base, prefix):
+    """Lista las subcarpetas de base que empiezan por prefix (la versión más reciente primero)."""
+    try:
+        with os.scandir(base) as entries:
+            dirs = [e for e in entries if e.is_dir() and e.name.startswith(prefix)]
+    except OSError:
+        return []
+    # Orden numérico: "17" va antes que "9.6" (con orden de texto sería al revés)
+    if len(dirs) > 1:
+        dirs.sort(key=lambda e: _version_key(e.name), reverse=True)
+    return [e.path for e in dirs]
+
+@lru_cache(maxsize=16)
 def find_executable(name):
     """Busca herramientas como psql, pg_restore o ogr2ogr."""
     path = shutil.which(name)
     if path: return path
     
-    common_paths = [
-        r"C:\Program Files\PostgreSQL\*\bin",
-        r"C:\Program Files (x86)\PostgreSQL\*\bin",
-        r"C:\OSGeo4W\bin",
-        r"C:\Program Files\QGIS*\bin"
-    ]
-    for pattern in common_paths:
-        matches = glob.glob(os.path.join(pattern, name + ".exe"))
-        matches.sort(reverse=True)
-        if matches: return matches[0]
+    exe = name + ".exe"
+    for base, prefix in COMMON_PATHS:
+        if prefix is None:
+            bin_dirs = [base]
+        else:
+            bin_dirs = [os.path.join(d, "bin") for d in _subdirs(base, prefix)]
+        for bin_dir in bin_dirs:
+            candidate = os.path.join(bin_dir, exe)
+            if os.path.exists(candidate): return candidate
     return None
 
+# Ruta de la instalación de PostgreSQL dentro de un mensaje de error (ej: C:/Program Files/PostgreSQL/17)
+_PG_PATH_RE = re.compile(r'([A-Za-z]:[\\/]Program Files[^"\'\n]*?PostgreSQL[\\/]\d+)', re.I)
+
+# creationflags solo existe en Windows (en otros sistemas debe ser 0)
+_DETACHED_FLAGS = (getattr(subprocess, "DETACHED_PROCESS", 0x00000008)
+                   | getattr(subprocess, "CREATE_NEW_PROCESS_GROUP", 0x00000200)) if os.name == "nt" else 0
+
+@lru_cache(maxsize=None)
+def _find_all_stackbuilders():
+    """Devuelve los stackbuilder.exe instalados, la versión más reciente primero."""
+    candidates = (os.path.join(d, "bin", "stackbuilder.exe") for d in _subdirs(r"C:\Program Files\PostgreSQL", ""))
+    return tuple(c for c in candidates if os.path.exists(c))
+
 def launch_stackbuilder_from_error(stderr_output):
     """
     Intenta deducir dónde está PostgreSQL basándose en la ruta del error
@@ -42,36 +119,18 @@ def launch_stackbuilder_from_error(stderr_output):
     print("\n🕵️ Intentando localizar el instalador de PostGIS...", flush=True)
     
     # El error suele ser algo como: "No such file... C:/Program Files/PostgreSQL/17/share/extension/postgis.control"
-    # Buscamos la ruta base
-    base_path = None
-    if "PostgreSQL" in stderr_output:
-        # Intentar extraer la ruta hasta la versión (ej: C:/Program Files/PostgreSQL/17)
-        try:
-            # Buscar el inicio de la ruta (C:/...)
-            start_idx = stderr_output.find("C:/") 
-            if start_idx == -1: start_idx = stderr_output.find("C:\\")
-            
-            if start_idx != -1:
-                # Cortar hasta 'share'
-                end_idx = stderr_output.find("share", start_idx)
-                if end_idx != -1:
-                    base_path = stderr_output[start_idx:end_idx].strip("/\\ ")
-        except:
-            pass
-
     stackbuilder_path = None
-    
-    # Si dedujimos la ruta del error
-    if base_path:
-        candidate = os.path.join(base_path, "bin", "stackbuilder.exe")
+    match = _PG_PATH_RE.search(stderr_output)
+    if match:
+        candidate = os.path.join(match.group(1), "bin", "stackbuilder.exe")
         if os.path.exists(candidate):
             stackbuilder_path = candidate
     
     # Si no, búsqueda bruta
     if not stackbuilder_path:
-        candidates = glob.glob(r"C:\Program Files\PostgreSQL\*\bin\stackbuilder.exe")
+        candidates = _find_all_stackbuilders()
         if candidates:
-            stackbuilder_path = candidates[-1] # El último (versión más reciente)
+            stackbuilder_path = candidates[0] # El primero (versión más reciente)
 
     if stackbuilder_path and os.path.exists(stackbuilder_path):
         print(f"✅ Instalador encontrado en: {stackbuilder_path}", flush=True)
@@ -84,9 +143,11 @@ def launch_stackbuilder_from_error(stderr_output):
         print("   5. Sigue los pasos para instalar. Cuando termine, vuelve aquí y ejecuta este script de nuevo.")
         
         try:
-            subprocess.Popen([stackbuilder_path])
+            # Proceso totalmente desacoplado: el script puede terminar sin esperar al instalador
+            subprocess.Popen([stackbuilder_path], creationflags=_DETACHED_FLAGS, close_fds=True,
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
             return True
-        except Exception as e:
+        except OSError as e:
             print(f"❌ Error al intentar abrirlo: {e}")
     else:
         print("❌ No pude encontrar 'stackbuilder.exe'.", flush=True)
@@ -95,143 +156,376 @@ def launch_stackbuilder_from_error(stderr_output):
     
     return False
 
-def force_enable_postgis():
-    """Intenta activar la extensión PostGIS manualmente antes de importar."""
-    print("\n--- PASO 1: ACTIVANDO POSTGIS EN LA BASE DE DATOS ---", flush=True)
-    tool = find_executable("psql")
-    if not tool:
-        print("❌ No encuentro psql. No puedo activar PostGIS.", file=sys.stderr)
-        return False
+# Se marca en True cuando PostGIS ya está activo, para no volver a comprobarlo
+_POSTGIS_READY = False
 
-    env = os.environ.copy()
-    env["PGPASSWORD"] = DB_PASSWORD
+POSTGIS_EXTENSIONS = {
+    "postgis": "CREATE EXTENSION IF NOT EXISTS postgis CASCADE;",
+    "postgis_topology": "CREATE EXTENSION IF NOT EXISTS postgis_topology;"
+}
 
-    commands = [
-        "CREATE EXTENSION IF NOT EXISTS postgis CASCADE;",
-        "CREATE EXTENSION IF NOT EXISTS postgis_topology;"
-    ]
+# Conexión compartida con psycopg (si está instalado), reutilizada en toda la ejecución
+_CONN = None
 
-    for sql in commands:
-        cmd = [tool, "-h", DB_HOST, "-p", DB_PORT, "-U", DB_USER, "-d", DB_NAME, "-c", sql]
+def _conn():
+    """Devuelve la conexión libpq compartida, abriéndola la primera vez."""
+    global _CONN
+    if _CONN is None or _CONN.closed:
+        _CONN = psycopg.connect(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER,
+                                password=DB_PASSWORD, sslmode=DB_SSLMODE, autocommit=True)
+    return _CONN
+
+def _report_postgis_error(err_msg):
+    """Muestra un error al crear una extensión; si falta PostGIS en el sistema lanza el instalador y sale."""
+    if "No such file or directory" in err_msg and "postgis.control" in err_msg:
+        print("\n🛑 FALTA POSTGIS EN EL SISTEMA.", file=sys.stderr)
+        launch_stackbuilder_from_error(err_msg)
+        sys.exit(1) # Detenemos el script para que el usuario instale
+    else:
+         print(f"⚠️ Error SQL (ignorable si ya existe): {err_msg}", file=sys.stderr)
+
+def _check_postgis(tool):
+    """Devuelve el conjunto de extensiones PostGIS ya instaladas en la base."""
+    sql = "SELECT string_agg(extname, ',') FROM pg_extension WHERE extname LIKE 'postgis%'"
+    cmd = [tool, "-h", DB_HOST, "-p", DB_PORT, "-U", DB_USER, "-d", DB_NAME, "-At", "-c", sql]
+    result = subprocess.run(cmd, env=_PG_ENV, capture_output=True, text=True, encoding="utf-8", errors="replace")
+    if result.returncode != 0:
+        return set()
+    return {name for name in result.stdout.strip().split(",") if name}
+
+def _enable_postgis_psycopg():
+    """Crea las extensiones que faltan usando la conexión compartida de psycopg."""
+    conn = _conn()
+    installed = {row[0] for row in conn.execute("SELECT extname FROM pg_extension WHERE extname LIKE 'postgis%'")}
+    ok = True
+    for name, sql in POSTGIS_EXTENSIONS.items():
+        if name in installed:
+            print(f"✅ Ya activa: {name}", flush=True)
+            continue
         try:
-            result = subprocess.run(cmd, env=env, capture_output=True, text=True)
-            if result.returncode == 0:
+            conn.execute(sql)
+            print(f"✅ Ejecutado: {sql}", flush=True)
+        except psycopg.Error as e:
+            ok = False
+            _report_postgis_error(str(e).strip())
+    return ok
+
+def _enable_postgis_psql(tool):
+    """Crea las extensiones que faltan con una única sesión de psql."""
+    installed = _check_postgis(tool)
+    for name in POSTGIS_EXTENSIONS:
+        if name in installed:
+            print(f"✅ Ya activa: {name}", flush=True)
+    pending = [sql for name, sql in POSTGIS_EXTENSIONS.items() if name not in installed]
+    if not pending:
+        return True
+
+    # Cada sentencia va en su propia línea para poder asociar los errores (psql:<stdin>:N:)
+    cmd = [tool, "-h", DB_HOST, "-p", DB_PORT, "-U", DB_USER, "-d", DB_NAME, "-f", "-"]
+    result = subprocess.run(cmd, env=_PG_ENV, input="\n".join(pending), capture_output=True,
+                            text=True, encoding="utf-8", errors="replace")
+    # stderr también trae NOTICE; solo nos interesan los errores
+    chunks = [e.strip() for e in result.stderr.split("psql:") if e.strip()]
+    errors = [e for e in chunks if "ERROR" in e or "FATAL" in e or "error:" in e]
+    if result.returncode != 0 and not errors and result.stderr.strip():
+        errors = [result.stderr.strip()]
+
+    failed_lines = set()
+    for err_msg in errors:
+        match = re.match(r"<stdin>:(\d+):", err_msg)
+        if match: failed_lines.add(int(match.group(1)))
+    # Un error sin número de línea (ej: conexión rechazada) significa que no se ejecutó nada
+    if len(failed_lines) == len(errors):
+        for line_no, sql in enumerate(pending, start=1):
+            if line_no not in failed_lines:
                 print(f"✅ Ejecutado: {sql}", flush=True)
-            else:
-                # Si falla, analizamos por qué
-                err_msg = result.stderr
-                if "No such file or directory" in err_msg and "postgis.control" in err_msg:
-                    print(f"\n🛑 FALTA POSTGIS EN EL SISTEMA.", file=sys.stderr)
-                    launch_stackbuilder_from_error(err_msg)
-                    sys.exit(1) # Detenemos el script para que el usuario instale
-                else:
-                     print(f"⚠️ Error SQL (ignorable si ya existe): {err_msg.strip()}", file=sys.stderr)
-
-        except Exception as e:
-            print(f"❌ Error intentando activar PostGIS: {e}")
 
-def detect_file_type(filepath):
+    for err_msg in errors:
+        _report_postgis_error(err_msg)
+    return result.returncode == 0 and not errors
+
+def force_enable_postgis():
+    """Intenta activar la extensión PostGIS manualmente antes de importar."""
+    global _POSTGIS_READY
+    if _POSTGIS_READY:
+        return True
+
+    print("\n--- PASO 1: ACTIVANDO POSTGIS EN LA BASE DE DATOS ---", flush=True)
     try:
-        with open(filepath, 'rb') as f:
-            header = f.read(15)
-        if header.startswith(b'PGDMP'): return "PG_DUMP_BINARY"
-        elif b'SQLite format 3' in header: return "GEOPACKAGE"
+        if psycopg is not None:
+            ok = _enable_postgis_psycopg()
         else:
-            try:
-                with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-                    start = f.read(100).upper()
-                    if "CREATE" in start or "SET" in start or "--" in start: return "SQL_SCRIPT"
-            except: pass
-    except: pass
+            # Sin psycopg recurrimos al binario psql
+            tool = find_executable("psql")
+            if not tool:
+                print("❌ No encuentro psql. No puedo activar PostGIS.", file=sys.stderr)
+                return False
+            ok = _enable_postgis_psql(tool)
+    except _DB_ERRORS as e:
+        ok = False
+        print(f"❌ Error intentando activar PostGIS: {e}")
+
+    _POSTGIS_READY = ok
+    return ok
+
+# Firmas binarias al inicio del archivo -> tipo detectado
+FILE_MAGIC = {
+    b'PGDMP': "PG_DUMP_BINARY",
+    b'SQLite format 3': "GEOPACKAGE",
+}
+
+def detect_file_type(filepath):
+    # Dump en formato directorio: se reconoce por su toc.dat
+    if os.path.isdir(filepath):
+        return "PG_DUMP_DIR" if os.path.exists(os.path.join(filepath, "toc.dat")) else "UNKNOWN"
+
+    # Una sola lectura binaria de la cabecera; todas las firmas se comprueban sobre bytes
+    try:
+        # os.read directo: evita crear un archivo con buffer para leer solo la cabecera
+        fd = os.open(filepath, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            head = os.read(fd, 512)
+        finally:
+            os.close(fd)
+    except OSError:
+        return "UNKNOWN"
+
+    for magic, ftype in FILE_MAGIC.items():
+        if head.startswith(magic): return ftype
+    start = head[:100].upper()
+    if b"CREATE" in start or b"SET" in start or b"--" in start: return "SQL_SCRIPT"
     return "UNKNOWN"
 
-def import_with_pg_restore(filepath):
-    print("\n--- PASO 2: IMPORTANDO ARCHIVO BINARIO (pg_restore) ---", flush=True)
-    
-    # PRIMERO ACTIVAMOS POSTGIS
-    force_enable_postgis()
+# La salida detallada de pg_restore va a este archivo (junto a import.py); en consola solo se ve el progreso
+PG_RESTORE_LOG = "pg_restore.log"
 
-    tool = find_executable("pg_restore")
-    if not tool:
-        print("❌ ERROR: No encuentro 'pg_restore'.", file=sys.stderr)
-        return
+def _run_pg_restore(cmd, log_f):
+    """
+    Ejecuta pg_restore volcando su salida al log y mostrando solo un resumen en consola.
+    Devuelve (código de salida, número de errores, True si el servidor rechazó conexiones).
+    """
+    p = subprocess.Popen(cmd, env=_PG_BULK_ENV, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                         text=True, encoding="utf-8", errors="replace", bufsize=1 << 16)
+    lines = errors = 0
+    too_many_clients = False
+    for line in p.stdout:
+        log_f.write(line)
+        lines += 1
+        if lines % 50 == 0:
+            print(f"\r   Operaciones registradas: {lines}", end="", flush=True)
+        if "error:" not in line and "ERROR" not in line:
+            continue
+        errors += 1
+        # Si falta PostGIS no tiene sentido esperar al final: cortamos y lanzamos el instalador.
+        # La activación de PostGIS ya terminó antes de arrancar pg_restore, así que solo este camino lo lanza.
+        if "postgis.control" in line:
+            p.terminate()
+            p.wait()
+            print("\n\n🛑 FALTA POSTGIS EN EL SISTEMA.", file=sys.stderr)
+            launch_stackbuilder_from_error(line)
+            sys.exit(1)
+        if "too many clients" in line:
+            too_many_clients = True
+    print(f"\r   Operaciones registradas: {lines}", flush=True)
+    return p.wait(), errors, too_many_clients
+
+# Entradas del TOC que suelen fallar al restaurar en otra base y no aportan datos
+TOC_SKIP_TYPES = ("COMMENT ", "ACL ", "DEFAULT ACL ")
+
+def _read_toc(tool, filepath):
+    """
+    Lee el índice (TOC) del archivo con `pg_restore -l`, sin conectarse a la base.
+    Se guarda en <archivo>.toc.cache y se reutiliza mientras el archivo no cambie.
+    """
+    # En formato directorio lo que cambia con cada dump es toc.dat, no la carpeta
+    st = os.stat(os.path.join(filepath, "toc.dat") if os.path.isdir(filepath) else filepath)
+    stamp = f"{st.st_mtime_ns} {st.st_size}\n"
+    # Sin el separador final: "GisTPI/" -> "GisTPI.toc.cache" junto a la carpeta, no dentro
+    cache_path = filepath.rstrip("/\\") + ".toc.cache"
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            if f.readline() == stamp:
+                return f.read().splitlines()
+    except OSError:
+        pass
 
-    env = os.environ.copy()
-    env["PGPASSWORD"] = DB_PASSWORD
+    result = subprocess.run([tool, "-l", filepath], env=_PG_ENV, capture_output=True,
+                            text=True, encoding="utf-8", errors="replace")
+    if result.returncode != 0:
+        return None
+    try:
+        with open(cache_path, "w", encoding="utf-8") as f:
+            f.write(stamp + result.stdout)
+    except OSError:
+        pass
+    return result.stdout.splitlines()
 
+def _toc_entry_desc(line):
+    """Devuelve "TIPO esquema nombre dueño" de una línea del TOC ("id; tableoid oid TIPO ..."), o None."""
+    if line.startswith(";") or ";" not in line: return None
+    parts = line.split(";", 1)[1].split(None, 2)
+    return parts[2] if len(parts) == 3 else None
+
+def _restore_archive(tool, filepath, jobs, toc_list_path):
+    """Lanza pg_restore (con reintento a -j 1 si el servidor rechaza conexiones)."""
     cmd = [
         tool,
         "-h", DB_HOST,
         "-p", DB_PORT,
         "-U", DB_USER,
         "-d", DB_NAME,
-        "-v",          # Verbose
+        "-v",          # Verbose (va al log, no a la consola)
         "-c",          # Clean (Borra tablas antes de crear)
         "--if-exists", # No da error si la tabla no existe al borrar
         "--no-owner",  # Ignora dueños originales
         "--no-acl",    # Ignora permisos originales
-        filepath
     ]
+    if toc_list_path:
+        cmd += ["-L", toc_list_path]  # Solo las entradas filtradas del TOC
+    if os.path.isdir(filepath):
+        cmd += ["-F", "d"]  # Formato directorio (pg_dump -Fd)
+
+    # Formato custom/directorio: pg_restore reparte datos e índices entre varios procesos.
+    # Con jobs=1 no se pasa -j (otros formatos, como tar, no admiten restauración en paralelo).
+    jobs = max(jobs, 1)
+    jobs_args = ["-j", str(jobs)] if jobs > 1 else []
+    log_path = os.path.join(_SCRIPT_DIR, PG_RESTORE_LOG)
     
-    print(f"Ejecutando restauración...", flush=True)
+    print(f"Ejecutando restauración ({jobs} procesos)...", flush=True)
+    print(f"📝 Detalle en: {log_path}", flush=True)
     try:
-        subprocess.run(cmd, env=env, check=False) 
+        with open(log_path, "w", encoding="utf-8") as log_f:
+            returncode, errors, too_many_clients = _run_pg_restore(cmd + jobs_args + [filepath], log_f)
+            # Si el servidor no acepta más conexiones, reintentamos en un solo proceso
+            if jobs > 1 and too_many_clients:
+                print("⚠️ El servidor rechaza conexiones extra, reintentando con -j 1...", flush=True)
+                log_f.write("\n--- REINTENTO CON -j 1 ---\n")
+                returncode, errors, _ = _run_pg_restore(cmd + [filepath], log_f)
+        if errors:
+            print(f"⚠️ pg_restore reportó {errors} errores (código {returncode}). Revisa el log.", flush=True)
         print("\n🎉 Proceso finalizado. Ignora advertencias menores si las tablas se crearon.", flush=True)
-    except Exception as e:
+    except OSError as e:
         print(f"\n⚠️ Error ejecutando pg_restore: {e}", flush=True)
 
-def import_with_psql(filepath):
-    print("\n--- PASO 2: IMPORTANDO SCRIPT SQL ---", flush=True)
-    force_enable_postgis() 
+def import_with_pg_restore(filepath, tool, jobs=PG_RESTORE_JOBS):
+    print("\n--- PASO 2: IMPORTANDO ARCHIVO BINARIO (pg_restore) ---", flush=True)
 
-    tool = find_executable("psql")
-    if not tool:
-        print("❌ ERROR: No encuentro 'psql'.", file=sys.stderr)
-        return
+    toc_list_path = None
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # PostGIS se activa en segundo plano mientras se lee el TOC (pg_restore -l no usa la base).
+            # Hay que esperar a que termine antes de restaurar: pg_restore -c --if-exists hace su propio
+            # DROP/CREATE EXTENSION y no puede competir con nuestro CREATE EXTENSION.
+            postgis_future = executor.submit(force_enable_postgis)
 
-    env = os.environ.copy()
-    env["PGPASSWORD"] = DB_PASSWORD
+            # Leemos el TOC para descartar entradas problemáticas. No sirve para decidir si hace falta
+            # PostGIS: los dumps con -n/-t no incluyen la extensión aunque sus tablas usen geometry.
+            toc = _read_toc(tool, filepath)
+            if toc is None:
+                print("⚠️ No pude leer el índice del archivo, se restaura completo.", flush=True)
+            else:
+                kept = [line for line in toc if not (_toc_entry_desc(line) or "").startswith(TOC_SKIP_TYPES)]
+                with tempfile.NamedTemporaryFile("w", suffix=".list", delete=False, encoding="utf-8") as f:
+                    f.write("\n".join(kept) + "\n")
+                    toc_list_path = f.name
+
+            # Si falta PostGIS en el servidor, aquí se propaga la salida del script (tras lanzar el instalador)
+            postgis_future.result()
+        _restore_archive(tool, filepath, jobs, toc_list_path)
+    finally:
+        if toc_list_path:
+            os.remove(toc_list_path)
+
+def import_with_psql(filepath, tool):
+    print("\n--- PASO 2: IMPORTANDO SCRIPT SQL ---", flush=True)
+    force_enable_postgis() 
 
-    cmd = [tool, "-h", DB_HOST, "-p", DB_PORT, "-U", DB_USER, "-d", DB_NAME, "-f", filepath]
+    # Todo el script en una sola transacción: un único COMMIT (y fsync) al final.
+    # Ante cualquier error se detiene y se deshace la importación completa.
+    cmd = [tool, "-h", DB_HOST, "-p", DB_PORT, "-U", DB_USER, "-d", DB_NAME,
+           "-v", "ON_ERROR_STOP=1", "--single-transaction", "-f", filepath]
     
     try:
-        subprocess.run(cmd, env=env, check=True)
+        subprocess.run(cmd, env=_PG_BULK_ENV, check=True)
         print("\n🎉 Importación SQL finalizada.", flush=True)
     except subprocess.CalledProcessError as e:
-        print(f"\n❌ Error ejecutando psql (Código {e.returncode}).", file=sys.stderr)
+        print(f"\n❌ Error ejecutando psql (Código {e.returncode}). La importación se deshizo por completo.", file=sys.stderr)
 
-def import_with_ogr2ogr(filepath):
+def import_with_ogr2ogr(filepath, tool):
     print("\n--- IMPORTANDO CON OGR2OGR ---", flush=True)
-    tool = find_executable("ogr2ogr")
     dsn = f"PG:host={DB_HOST} port={DB_PORT} dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD}"
-    cmd = [tool, "-f", "PostgreSQL", dsn, filepath, "-overwrite", "-nln", "GisTPI_import"]
+    # PG_USE_COPY: carga con COPY en lugar de un INSERT por fila; -gt agrupa filas por transacción
+    cmd = [
+        tool,
+        "--config", "PG_USE_COPY", "YES",
+        "--config", "PG_USE_BASE64", "YES",
+        "-f", "PostgreSQL", dsn, filepath,
+        "-overwrite",
+        "-nln", "GisTPI_import",
+        "-gt", "65536",
+        "-lco", "SPATIAL_INDEX=GIST",
+        "-lco", "GEOMETRY_NAME=geom",
+        "-lco", "PRECISION=NO",
+        "-progress"
+    ]
     subprocess.run(cmd)
 
 # --- EJECUCIÓN ---
-def resolve_input_file(filename_raw):
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    path = os.path.join(script_dir, filename_raw)
-    if os.path.isfile(path): return path
+@lru_cache(maxsize=None)
+def resolve_input_file(filename_raw, base_dir=_SCRIPT_DIR):
+    """Busca el archivo (o carpeta de dump); las rutas relativas se resuelven contra base_dir."""
+    path = os.path.join(base_dir, filename_raw)  # Si filename_raw es absoluta, join la devuelve tal cual
+    if os.path.exists(path): return path
     return None
 
+# Herramienta que necesita cada tipo de archivo (UNKNOWN se intenta con pg_restore)
+REQUIRED_TOOL = {
+    "PG_DUMP_BINARY": "pg_restore",
+    "PG_DUMP_DIR": "pg_restore",
+    "SQL_SCRIPT": "psql",
+    "GEOPACKAGE": "ogr2ogr",
+    "UNKNOWN": "pg_restore",
+}
+
 if __name__ == "__main__":
     print("--- INICIANDO PROCESO DE RECUPERACIÓN ---", flush=True)
+
+    # Buscamos las tres herramientas a la vez (cada búsqueda recorre carpetas de instalación)
+    tool_names = ("psql", "pg_restore", "ogr2ogr")
+    with ThreadPoolExecutor(len(tool_names)) as executor:
+        tools = dict(zip(tool_names, executor.map(find_executable, tool_names)))
     
-    input_path = resolve_input_file(INPUT_FILENAME)
+    # El nombre por defecto se busca junto a import.py; una ruta pasada como argumento, desde el directorio actual
+    base_dir = os.getcwd() if len(sys.argv) > 1 else _SCRIPT_DIR
+    input_path = resolve_input_file(INPUT_FILENAME, base_dir)
     
     if not input_path:
         print(f"❌ No encuentro el archivo '{INPUT_FILENAME}'.", file=sys.stderr)
         sys.exit(1)
         
     file_type = detect_file_type(input_path)
+    # Una carpeta solo vale si es un dump en formato directorio (con toc.dat)
+    if os.path.isdir(input_path) and file_type != "PG_DUMP_DIR":
+        print(f"❌ No encuentro el archivo '{INPUT_FILENAME}' (es una carpeta sin toc.dat).", file=sys.stderr)
+        sys.exit(1)
     print(f"Tipo de archivo: {file_type}", flush=True)
+
+    # Sin la herramienta necesaria no tocamos la base
+    tool_name = REQUIRED_TOOL[file_type]
+    tool = tools[tool_name]
+    if not tool:
+        print(f"❌ ERROR: No encuentro '{tool_name}'.", file=sys.stderr)
+        sys.exit(1)
     
     if file_type == "PG_DUMP_BINARY":
-        import_with_pg_restore(input_path)
+        import_with_pg_restore(input_path, tool)
+    elif file_type == "PG_DUMP_DIR":
+        import_with_pg_restore(input_path, tool, jobs=PG_RESTORE_DIR_JOBS)
     elif file_type == "SQL_SCRIPT":
-        import_with_psql(input_path)
+        import_with_psql(input_path, tool)
     elif file_type == "GEOPACKAGE":
-        import_with_ogr2ogr(input_path)
+        import_with_ogr2ogr(input_path, tool)
     else:
+        # Puede ser un dump tar (sin cabecera PGDMP): pg_restore no lo admite en paralelo
         print("⚠️ Formato desconocido, probando pg_restore...", flush=True)
-        import_with_pg_restore(input_path)
\ No newline at end of file
+        import_with_pg_restore(input_path, tool, jobs=1)